@@ -1,17 +1,30 @@
 """Documentation generator for Python projects."""
+import argparse
+import dataclasses
+import functools
+import io
+import logging
 import os
+import re
 import shutil
 import subprocess
 import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, TypedDict
+from typing import Iterator, Optional, Sequence
 
-from jinja2 import Environment, PackageLoader
-import tomli
+from jinja2 import Environment, FileSystemBytecodeCache, PackageLoader, Template
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
 
 from doccer.types import EmailContact, ProjectType
 
+log = logging.getLogger("doccer")
+
 
 def _jinja_env() -> Environment:
     """
@@ -19,13 +32,51 @@ def _jinja_env() -> Environment:
 
     :return: jinja2 environment
     """
-    return _jinja_env.env or Environment(loader=PackageLoader("doccer"))
+    if _jinja_env.env is None:
+        _jinja_env.env = Environment(
+            loader=PackageLoader("doccer"),
+            # Keep compiled templates between runs, since the hook runs on every commit. With no
+            # directory given, jinja2 uses a private per-user dir under the system temp dir.
+            bytecode_cache=FileSystemBytecodeCache(),
+            auto_reload=False,
+            cache_size=-1,
+        )
+    return _jinja_env.env
 
 
 _jinja_env.env = None
 
-
-class DerivedConfigData(TypedDict):
+# Compiled templates, keyed by template name:
+_TEMPLATE_CACHE: dict[str, Template] = {}
+
+# Parsed pyproject.toml files, keyed by absolute path:
+_PYPROJECT_CACHE: dict[str, dict] = {}
+
+# Progress line printed by sphinx-build for each document it writes, e.g.
+# "writing output... [ 50%] docs/subpage":
+_WRITING_OUTPUT_RE = re.compile(
+    r"^writing output\.\.\. (?:\[\s*\d+%\] )?(?P<docname>\S.*?)\s*$"
+)
+
+# Directories that are never searched for pyproject.toml files:
+_PRUNE_DIRS = frozenset(
+    {
+        ".git",
+        ".venv",
+        "venv",
+        "node_modules",
+        ".tox",
+        "build",
+        "dist",
+        "__pycache__",
+        ".mypy_cache",
+        "site-packages",
+    }
+)
+
+
+@dataclasses.dataclass(slots=True)
+class DerivedConfigData:
     """Data computed from configuration files. All of these fields can be counted on to exist
     and have reasonable values.
     """
@@ -36,70 +87,184 @@ class DerivedConfigData(TypedDict):
     project_name: str
 
 
-class DocConfig(TypedDict):
+@dataclasses.dataclass(slots=True)
+class DocConfig:
     """Documentation configuration."""
 
     pyproject_path: str
     doc_src: str
     doc_dest: str
+    build_in_place: bool
     pyproject_data: dict
     py_modules: list[str]
     derived: DerivedConfigData
 
 
-def precommit_hook() -> None:
+def precommit_hook(argv: Optional[Sequence[str]] = None) -> None:
     """
     This is the entry point when called as a pre-commit hook. It will build documentation from
     source, or create and build some example documentation source files if none are found.
 
-    TODO: add details about how configs are found and how they are used to build docs.
+    Configs are the ``[tool.doccer]`` tables of ``pyproject.toml`` files anywhere in the
+    repository. Hidden directories are not searched, nor are virtualenvs, build output and the
+    like: ``.git``, ``.venv``, ``venv``, ``node_modules``, ``.tox``, ``build``, ``dist``,
+    ``__pycache__``, ``.mypy_cache`` and ``site-packages``. Pass ``--exclude-dir NAME`` to skip
+    more directories, or ``--include-dir NAME`` to search one of these anyway. The docs for each
+    config are built with sphinx in a temp dir, then deployed.
 
+    :param argv: Command line arguments. Defaults to ``sys.argv[1:]``.
     :return: None
     """
 
-    # Find and act on configs in pyproject.toml file(s):
-    configs = _load_configs()
+    parser = argparse.ArgumentParser(prog="doccer_hook")
+    parser.add_argument(
+        "--exclude-dir",
+        action="append",
+        default=[],
+        help="directory name to skip when searching for pyproject.toml files (repeatable)",
+    )
+    parser.add_argument(
+        "--include-dir",
+        action="append",
+        default=[],
+        help="directory name to search even though it is skipped by default (repeatable)",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="show debug output (also enabled by setting DOCCER_VERBOSE)",
+    )
+    parser.add_argument("filenames", nargs="*", help="ignored; passed in by pre-commit")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="[doccer] %(message)s")
+    if args.verbose or os.environ.get("DOCCER_VERBOSE"):
+        log.setLevel(logging.DEBUG)
 
+    # Find and act on configs in pyproject.toml file(s):
+    include = frozenset(args.include_dir)
+    configs = _load_configs(
+        prune=(_PRUNE_DIRS | frozenset(args.exclude_dir)) - include, keep=include
+    )
+    if not configs:
+        return
+
+    # Configs can share a doc source dir, so generate missing doc sources one config at a time,
+    # before any building starts:
     for config in configs:
+        log.debug("config found: %s", config)
+        _ensure_doc_source(config)
+
+    # Use subdirs of a single temp dir as the build destinations, so there's only one directory
+    # to create and clean up:
+    with tempfile.TemporaryDirectory() as tmp_root:
+        for i, config in enumerate(configs):
+            config.derived.build_dir = os.path.join(tmp_root, str(i))
+            os.mkdir(config.derived.build_dir)
+
+        # Each config is built by its own sphinx-build subprocess, so the work is almost
+        # entirely spent waiting on child processes. Threads are enough to overlap them, and
+        # avoid having to pickle configs the way a process pool would.
+        max_workers = min(len(configs), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            written = list(executor.map(_build_config, configs))
+
+        # Configs can also share a deploy dir, so deploy one config at a time, in order. Later
+        # configs win, the same as if everything had run in sequence:
+        for config, config_written in zip(configs, written):
+            _deploy_config(config, config_written)
+
+
+def _ensure_doc_source(config: DocConfig) -> None:
+    """
+    Generate sample documentation source files for a config, if it has no usable doc source.
+
+    :param config: Configuration options from pyproject.toml.
+    :return: None
+    """
+
+    # Sphinx can't build without a conf.py, so that's what tells us whether there's a usable
+    # doc source:
+    try:
+        os.stat(os.path.join(config.doc_src, "conf.py"))
+    except FileNotFoundError:
+        log.debug("doc source not found. generating sample docs")
+        _generate_sample_docs_source(config)
 
-        # Use a temp dir as the build destination:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            config["derived"]["build_dir"] = tmpdir
 
-            _debug_out(f"config found: {config}")
+def _build_config(config: DocConfig) -> list[str]:
+    """
+    Build the documentation for a config into its build dir. This only writes to the build dir,
+    which must already exist, so it is safe to run for several configs at once. Configs that are
+    built in place are skipped here and built by `_deploy_config` instead.
+
+    :param config: Configuration options from pyproject.toml.
+    :return: Names of the documents that were written, as returned by `_build_with_sphinx`.
+    """
+
+    if config.build_in_place:
+        return []
+    return _build_with_sphinx(config)
+
+
+def _deploy_config(config: DocConfig, written: list[str]) -> None:
+    """
+    Deploy the documentation built by `_build_config`, or build it straight into the deploy dir
+    for configs that are built in place.
+
+    :param config: Configuration options from pyproject.toml.
+    :param written: Names of the documents written by `_build_config`.
+    :return: None
+    """
 
-            if not Path(config["doc_src"]).exists():
-                _debug_out(f"doc source dir not found. generating sample docs")
-                _generate_sample_docs_source(config)
+    if config.build_in_place:
+        # Sphinx writes straight into the deploy dir, so there is nothing to deploy afterwards:
+        _build_with_sphinx(config, outdir=config.derived.deploy_dir)
+        return
 
-            _build_with_sphinx(config)
-            _debug_out(f"deploying docs to {config['derived']['deploy_dir']}")
-            _deploy_docs(config)
+    log.debug("deploying docs to %s", config.derived.deploy_dir)
+    _deploy_docs(config, written)
 
 
 def _generate_sample_docs_source(config: DocConfig) -> None:
     """
-    Generate sample documentation source files.
+    Generate sample documentation source files. Only missing files are created, so anything
+    already in the doc source dir is kept.
 
     :param config: Configuration options from pyproject.toml.
     :return: None
     """
 
-    source_path = Path(config["doc_src"])
-    # Root document:
-    _render_template("README.rst.jinja2", source_path, **config)
-    # Example subpage:
-    _render_template("subpage.rst.jinja2", source_path / "docs", **config)
-    # Sphinx config and makefile:
-    _render_template("conf.py.jinja2", source_path, **config)
-    _render_template("Makefile.jinja2", source_path, **config)
+    source_path = Path(config.doc_src)
+    # Templates see the top-level config fields as variables. This is a shallow copy, so nested
+    # data like pyproject_data is shared rather than duplicated:
+    context = {
+        field.name: getattr(config, field.name) for field in dataclasses.fields(config)
+    }
+    templates = [
+        # Root document:
+        ("README.rst.jinja2", source_path),
+        # Example subpage:
+        ("subpage.rst.jinja2", source_path / "docs"),
+        # Sphinx config and makefile:
+        ("conf.py.jinja2", source_path),
+        ("Makefile.jinja2", source_path),
+    ]
+    # The files are independent of each other, so write them concurrently:
+    with ThreadPoolExecutor(max_workers=len(templates)) as executor:
+        futures = [
+            executor.submit(_render_template, template_name, dest_dir, **context)
+            for template_name, dest_dir in templates
+        ]
+        for future in futures:
+            future.result()
 
 
 def _render_template(template_name: str, dest_dir: os.PathLike, **kwargs) -> None:
     """
     Render a template to a destination directory. The destination directory will be created if
     it does not exist. The destination filename will be the same as the template name, minus the
-    .jinja2 extension.
+    .jinja2 extension. An existing destination file is never overwritten.
 
     :param template_name:
     :param dest_dir:
@@ -107,25 +272,56 @@ def _render_template(template_name: str, dest_dir: os.PathLike, **kwargs) -> Non
     :return: None
     """
 
-    template = _jinja_env().get_template(template_name)
-
-    os.makedirs(dest_dir, exist_ok=True)
-    with open(Path(dest_dir) / template_name.replace(".jinja2", ""), "w") as f:
-        f.write(template.render(**kwargs))
+    template = _TEMPLATE_CACHE.get(template_name)
+    if template is None:
+        template = _jinja_env().get_template(template_name)
+        _TEMPLATE_CACHE[template_name] = template
 
+    # Collect the rendered chunks and write them with as few syscalls as possible, bypassing the
+    # buffered file object that open() would wrap around the fd:
+    buf = io.BytesIO()
+    for chunk in template.generate(**kwargs):
+        buf.write(chunk.encode("utf-8"))
 
-def _load_configs(repo_root: os.PathLike = ".") -> list[DocConfig]:
+    os.makedirs(dest_dir, exist_ok=True)
+    dest = os.path.join(dest_dir, template_name.removesuffix(".jinja2"))
+    try:
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        log.debug("%s already exists, not overwriting it", dest)
+        return
+    try:
+        with buf.getbuffer() as data:
+            written = 0
+            while written < len(data):
+                written += os.write(fd, data[written:])
+    finally:
+        os.close(fd)
+
+
+def _load_configs(
+    repo_root: os.PathLike = ".",
+    prune: frozenset[str] = _PRUNE_DIRS,
+    keep: frozenset[str] = frozenset(),
+) -> list[DocConfig]:
     """
     Find all `pyproject.toml` files in the repository and create a `DocConfig` instance for each.
 
     :param repo_root: Root of the repository to search for pyproject.toml files. Defaults to the
         current working directory, which will be the repository root when called as a pre-commit.
+    :param prune: Names of directories not to descend into.
+    :param keep: Names of hidden directories to search anyway. Other hidden directories are
+        skipped.
     :return: list of DocConfig instances
     """
 
     # for now we only support pyproject.toml
-    pyprojects = list(Path(repo_root).rglob("pyproject.toml"))
-    _debug_out(f"Found {len(pyprojects)} pyprojects: {pyprojects}")
+    pyprojects = [
+        entry.path
+        for entry in _scandir_recursive(repo_root, prune, skip_hidden=True, keep=keep)
+        if entry.name == "pyproject.toml"
+    ]
+    log.debug("Found %d pyprojects: %s", len(pyprojects), pyprojects)
 
     configs = []
     for pyproject in pyprojects:
@@ -144,84 +340,195 @@ def _load_config(pyproject: os.PathLike) -> Optional[DocConfig]:
     :return:
     """
 
+    # Most pyproject.toml files in a repo won't configure doccer at all, so avoid parsing those:
     with open(pyproject, "rb") as f:
-        toml = tomli.load(f)
+        data = f.read()
+    if b"doccer" not in data:
+        return None
+
+    toml = _parse_pyproject(str(pyproject), data)
 
     if (magdocs_config := toml.get("tool", {}).get("doccer")) is not None:
 
         src_dir = magdocs_config.get("doc_src", "docs/src")
 
-        derived_config = {}
         if toml["project"].get("authors"):
-            derived_config["author"] = toml["project"]["authors"][0]
+            author = toml["project"]["authors"][0]
         else:
-            derived_config["author"] = EmailContact(name="unknown", email="unknown")
-
-        # todo: make these configurable
-        derived_config["build_dir"] = str(Path(src_dir).parent / "build")
-        derived_config["deploy_dir"] = "."
-
-        return {
-            "pyproject_path": str(pyproject),
-            "pyproject_data": toml,
-            "doc_src": src_dir,
-            "doc_dest": magdocs_config.get("doc_dest", "."),
-            "derived": derived_config,
-            "py_modules": magdocs_config.get("py_modules", [toml["project"]["name"]]),
-        }
-
-
-def _build_with_sphinx(config: DocConfig) -> bool:
+            author = EmailContact(name="unknown", email="unknown")
+
+        derived_config = DerivedConfigData(
+            author=author,
+            # todo: make these configurable
+            build_dir=str(Path(src_dir).parent / "build"),
+            deploy_dir=".",
+            project_name=toml["project"]["name"],
+        )
+
+        build_in_place = magdocs_config.get("build_in_place", False)
+        if not isinstance(build_in_place, bool):
+            raise ValueError(
+                f"{pyproject}: [tool.doccer] build_in_place must be true or false, "
+                f"not {build_in_place!r}"
+            )
+
+        return DocConfig(
+            pyproject_path=str(pyproject),
+            pyproject_data=toml,
+            doc_src=src_dir,
+            doc_dest=magdocs_config.get("doc_dest", "."),
+            build_in_place=build_in_place,
+            derived=derived_config,
+            py_modules=magdocs_config.get("py_modules", [toml["project"]["name"]]),
+        )
+
+
+def _build_with_sphinx(config: DocConfig, outdir: Optional[str] = None) -> list[str]:
     """
-    Call out to ``sphinx-build`` to render the documentation files from source.
+    Call out to ``sphinx-build`` to render the documentation files from source. Sphinx's doctree
+    cache always goes in the build dir, so it never ends up in the deploy dir.
 
     :param config: Configuration options from pyproject.toml.
-    :return: True if files were changed, False otherwise.
+    :param outdir: Where to write the rendered files. Defaults to the build dir.
+    :return: Names of the documents that were written, as reported by sphinx. This is empty if no
+        files were changed.
     """
 
+    # subprocess only uses posix_spawn when given a path to the executable, not a bare name:
+    sphinx_build = shutil.which("sphinx-build")
+    if sphinx_build is None:
+        raise FileNotFoundError("sphinx-build not found on PATH; is sphinx installed?")
+
     cmd = [
-        "sphinx-build",
+        sphinx_build,
         "-b",  # builder to use is...
         "rst",  # reStructuredText
-        config["doc_src"],
-        config["derived"]["build_dir"],
+        "-N",  # no colored output, so progress lines can be parsed
+        "-d",  # doctree cache dir
+        os.path.join(config.derived.build_dir, ".doctrees"),
+        config.doc_src,
+        outdir or config.derived.build_dir,
     ]
-    _debug_out(f"Building docs with sphinx: {cmd=}")
-    sphinx_proc = subprocess.run(cmd, check=True, capture_output=True)
-
-    _debug_out(f"sphinx stdout: {sphinx_proc.stdout.decode()}")
-    _debug_out(f"sphinx exit code: {sphinx_proc.returncode}")
-
-    # Exit with status code 1 if files were changed:
-    return b"writing output" in sphinx_proc.stdout
-
-
-def _deploy_docs(config: DocConfig) -> None:
+    log.debug("Building docs with sphinx: cmd=%r", cmd)
+    # Scan the output line by line as it arrives rather than buffering all of it. stderr is
+    # merged in so warnings and errors still show up in the debug output.
+    #
+    # close_fds=False spares the child from closing every possible fd up to the fd limit, and
+    # (with the resolved path above) lets subprocess use posix_spawn where the platform supports
+    # it. It's safe because Python opens files non-inheritable, so only the pipe set up here is
+    # passed on.
+    #
+    # Sphinx translates its console messages, so force the C locale to get the English progress
+    # lines that _WRITING_OUTPUT_RE expects.
+    written: list[str] = []
+    with subprocess.Popen(
+        cmd,
+        env={**os.environ, "LC_ALL": "C", "LANGUAGE": "C"},
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        bufsize=1,
+        text=True,
+        close_fds=False,
+    ) as sphinx_proc:
+        for line in sphinx_proc.stdout:
+            log.debug("sphinx: %s", line.rstrip())
+            if match := _WRITING_OUTPUT_RE.match(line):
+                written.append(match["docname"])
+
+    log.debug("sphinx exit code: %s", sphinx_proc.returncode)
+    if sphinx_proc.returncode:
+        raise subprocess.CalledProcessError(sphinx_proc.returncode, cmd)
+
+    return written
+
+
+def _deploy_docs(config: DocConfig, written: list[str]) -> None:
     """
     Deploy the rendered documentation to the configured destination.
 
     :param config: Configuration options from pyproject.toml.
+    :param written: Names of the documents written by sphinx, as returned by
+        `_build_with_sphinx`. If this is empty, the build dir is searched for .rst files instead.
     :return: None
     """
-    deploy_to = Path(config["derived"]["deploy_dir"])
-    _debug_out(f"deploying docs to {deploy_to}")
+    deploy_to = os.fspath(config.derived.deploy_dir)
+    log.debug("deploying docs to %s", deploy_to)
+
+    build_dir = os.fspath(config.derived.build_dir)
+    # Files can simply be renamed into place when the build dir is on the same filesystem:
+    same_device = os.stat(build_dir).st_dev == os.stat(deploy_to).st_dev
+    created_dirs = set()
+    if not written:
+        # Nothing was recognized in sphinx's output. That shouldn't happen for a fresh build, so
+        # say so, then find the built files ourselves:
+        log.warning("no documents found in sphinx output; searching build dir instead")
+        written = [
+            os.path.relpath(docfile.path, build_dir).removesuffix(".rst")
+            for docfile in _scandir_recursive(build_dir, skip_hidden=True)
+            if docfile.name.endswith(".rst")
+        ]
+
+    for docname in written:
+        docfile = os.path.join(build_dir, docname + ".rst")
+        dest = os.path.join(deploy_to, docname + ".rst")
+        dest_parent = os.path.dirname(dest)
+        if dest_parent not in created_dirs:
+            os.makedirs(dest_parent, exist_ok=True)
+            created_dirs.add(dest_parent)
+        if same_device:
+            os.replace(docfile, dest)
+        else:
+            # The file mode of generated docs doesn't matter, so skip copying it:
+            shutil.copyfile(docfile, dest)
 
-    for docfile in Path(config["derived"]["build_dir"]).rglob("*.rst"):
-        dest = deploy_to / docfile.relative_to(config["derived"]["build_dir"])
-        shutil.copy(docfile, dest)
 
+def _scandir_recursive(
+    root: os.PathLike,
+    prune: frozenset[str] = frozenset(),
+    skip_hidden: bool = False,
+    keep: frozenset[str] = frozenset(),
+) -> Iterator[os.DirEntry]:
+    """
+    Walk a directory tree, yielding an ``os.DirEntry`` for every regular file found. Symlinks are
+    not followed, and directories that cannot be read are silently skipped.
+
+    :param root: Directory to start the walk from.
+    :param prune: Names of directories not to descend into.
+    :param skip_hidden: If True, don't descend into directories whose names start with a dot.
+    :param keep: Names of hidden directories to descend into even when `skip_hidden` is True.
+    :return: iterator of ``os.DirEntry`` objects for files under `root`
+    """
 
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in prune:
+                        continue
+                    is_hidden = entry.name.startswith(".")
+                    if skip_hidden and is_hidden and entry.name not in keep:
+                        continue
+                    yield from _scandir_recursive(entry.path, prune, skip_hidden, keep)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+    except (PermissionError, FileNotFoundError):
+        return
+
+
+@functools.lru_cache(maxsize=None)
 def _get_project_type(project_root: os.PathLike = ".") -> ProjectType:
     """
-    Determine the flavor of the project by looking for certain files in the project root.
+    Determine the flavor of the project by looking for certain files in the project root. The
+    result is cached per `project_root`.
 
     :param project_root: Root of the project to check. Defaults to the current working directory,
         which will be the repository root when called as a pre-commit.
     :return: ProjectType
     """
 
-    if Path(project_root) / "pyproject.toml":
-        toml = tomli.load(open(Path(project_root) / "pyproject.toml", "rb"))
+    pyproject = Path(project_root) / "pyproject.toml"
+    if pyproject.exists():
+        toml = _parse_pyproject(str(pyproject))
 
         if toml.get("tool", {}).get("poetry"):
             return ProjectType.POETRY
@@ -229,19 +536,28 @@ def _get_project_type(project_root: os.PathLike = ".") -> ProjectType:
         elif toml.get("tool", {}).get("pdm"):
             return ProjectType.PDM
 
-    elif Path(project_root) / "setup.py":
+    if (Path(project_root) / "setup.py").exists():
         return ProjectType.SETUP_PY
 
-    else:
-        return ProjectType.UNKNOWN
+    return ProjectType.UNKNOWN
 
 
-def _debug_out(msg: str) -> None:
+def _parse_pyproject(path: str, data: Optional[bytes] = None) -> dict:
     """
-    Print a debug message. It will only be shown if pre-commit is invoked with --verbose.
+    Parse a ``pyproject.toml`` file. Results are cached by absolute path, so each file is only read
+    and parsed once per run, however it is referred to; callers must not modify the returned dict.
 
-    :param msg: the message to output.
-    :return: None
+    :param path: Path to the pyproject.toml file.
+    :param data: Contents of the file, if the caller has already read it.
+    :return: the parsed TOML data
     """
 
-    print(f"[maglogs] {msg}")
+    key = os.path.abspath(path)
+    toml = _PYPROJECT_CACHE.get(key)
+    if toml is None:
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        toml = tomllib.loads(data.decode("utf-8"))
+        _PYPROJECT_CACHE[key] = toml
+    return toml
@@ -1,7 +1,10 @@
 from abc import abstractmethod
 import os
 
-import tomli
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
 
 
 class ProjectReader:
@@ -14,4 +17,4 @@ class ProjectReader:
 class PyprojectReader(ProjectReader):
     def __init__(self, pyproject_path: os.PathLike):
         with open(pyproject_path, "rb") as f:
-            self.toml = tomli.load(f)
+            self.toml = tomllib.load(f)
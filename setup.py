@@ -23,7 +23,7 @@ setup_kwargs = {
     ],
     "package_data": {"": ["*"]},
     "install_requires": INSTALL_REQUIRES,
-    "python_requires": ">=3.8",
+    "python_requires": ">=3.10",
     "entry_points": {
         "console_scripts": [
             "doccer_hook = doccer:precommit_hook",